@@ -33,6 +33,7 @@ def build_parser() -> argparse.ArgumentParser:
         help="Main (single) command to run; should use parameters such as "
         "{dataset} to be substituted in each run",
         type=str,
+        required=True,
     )
     parser.add_argument(
         "--array",
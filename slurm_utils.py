@@ -2,19 +2,49 @@
 
 """Functions to simplify running parameterised sbatch array jobs.
 
-Can be called to produce total count of all possible parameters and
-the nth product.
+Can be called to produce total count of all possible parameters,
+the nth product, or the commands for all of the products.
 """
 
 import argparse
 import os
+import string
 import tempfile
+import types
 import warnings
-from collections import OrderedDict
-from functools import reduce
-from operator import mul
-
-import slurm_toml_decoder as toml
+from functools import lru_cache
+from math import prod
+
+try:
+    import tomllib
+except ImportError:
+    try:
+        import tomli as tomllib
+    except ImportError:
+        # Neither is available (Python < 3.11 without tomli installed), so
+        # use the bundled pure-Python decoder instead.
+        tomllib = None
+        import slurm_toml_decoder
+
+# Bash's own $ signs have to be written as $$ here
+_BATCHFILE_TEMPLATE = string.Template(
+    """#!/bin/bash
+${sbatch_config}
+
+cd ${pwd}
+
+case "$$SLURM_ARRAY_TASK_ID" in
+${commands}    *)
+        echo "No command for array task $$SLURM_ARRAY_TASK_ID" >&2
+        exit 1
+        ;;
+esac
+
+${setup}
+
+$$command
+"""
+)
 
 
 def get_count(params):
@@ -22,9 +52,30 @@ def get_count(params):
 
 
 def read_toml(filename):
-    with open(filename, "r", encoding="UTF-8") as tomlfile:
-        toml_dict = toml.load(tomlfile, _dict=OrderedDict)
-    return toml_dict
+    """Read a TOML file, returning a read-only mapping of its contents.
+
+    Parsed files are cached by their real path, modification time and
+    size, so reading the same unmodified file again does not reparse it.
+    Only the top-level mapping is read-only; the values in it are shared
+    with the cache and should not be modified.
+    """
+    path = os.path.realpath(filename)
+    stat = os.stat(path)
+    return _read_toml_cached(path, stat.st_mtime_ns, stat.st_size)
+
+
+@lru_cache(maxsize=None)
+def _read_toml_cached(filename, mtime_ns, size):
+    # pylint: disable=unused-argument
+    # mtime_ns and size are only part of the cache key, so that modified
+    # files are reread
+    if tomllib is not None:
+        with open(filename, "rb") as tomlfile:
+            toml_dict = tomllib.load(tomlfile)
+    else:
+        with open(filename, "r", encoding="UTF-8") as tomlfile:
+            toml_dict = slurm_toml_decoder.load(tomlfile)
+    return types.MappingProxyType(toml_dict)
 
 
 def read_paramfile(filename):
@@ -37,9 +88,10 @@ def validate_param_dict(dict_lists):
     """Validate data read from a TOML parameters file.
 
     Every item should have the form str: list
-    The function returns the valid entries.
+    The function returns the valid entries, with each list copied so that
+    changing them does not affect the data cached by `read_toml`.
     """
-    outdict = OrderedDict()
+    outdict = {}
     for key, val in dict_lists.items():
         if not isinstance(key, str):
             warnings.warn(
@@ -53,19 +105,14 @@ def validate_param_dict(dict_lists):
                 UserWarning,
             )
             continue
-        outdict[key] = val
+        outdict[key] = list(val)
 
     return outdict
 
 
 def count_product(lists):
     """The product of the lengths of the iterables in the list of lists."""
-    lengths = list(map(len, lists))
-
-    if len(lengths) == 0:
-        return 1
-
-    return reduce(mul, lengths)
+    return prod(map(len, lists))
 
 
 def nth_product(index, lists):
@@ -80,16 +127,15 @@ def nth_product(index, lists):
 
     ``IndexError`` will be raised if the given *index* is invalid.
 
-    This code is taken from `more_itertools`; this saves us from an external
+    This code is adapted from `more_itertools`; this saves us from an external
     dependency.  License: MIT
     """
-    pools = list(map(tuple, reversed(lists)))
-    lengths = list(map(len, pools))
+    pools, strides = _compile_product(lists)
 
-    if len(lengths) == 0:
+    if len(pools) == 0:
         return tuple()
 
-    total = reduce(mul, lengths)
+    total = strides[0] * len(pools[0])
 
     if index < 0:
         index += total
@@ -98,11 +144,32 @@ def nth_product(index, lists):
         raise IndexError
 
     result = []
-    for pool, length in zip(pools, lengths):
-        result.append(pool[index % length])
-        index //= length
+    for pool, stride in zip(pools, strides):
+        position, index = divmod(index, stride)
+        result.append(pool[position])
 
-    return tuple(reversed(result))
+    return tuple(result)
+
+
+def _compile_product(lists):
+    """Prepare `lists` for mixed-radix decoding of product indices.
+
+    Returns the tuple of pools and the tuple of strides, where the stride
+    of a pool is the product of the lengths of all the later pools.
+    """
+    pools = tuple(map(tuple, lists))
+    strides = _product_strides(tuple(map(len, pools)))
+    return pools, strides
+
+
+@lru_cache(maxsize=None)
+def _product_strides(lengths):
+    strides = []
+    stride = 1
+    for length in reversed(lengths):
+        strides.append(stride)
+        stride *= length
+    return tuple(reversed(strides))
 
 
 def get_array_argument(template, paramfile):
@@ -116,16 +183,16 @@ def get_array_argument(template, paramfile):
 
 
 def overrides_to_dict(overrides):
-    out = OrderedDict()
+    out = {}
     for override in overrides:
-        keyval = override.split("=", maxsplit=1)
-        if len(keyval) < 2:
+        key, sep, val = override.partition("=")
+        if not sep:
             warnings.warn(
                 f"--sbatch option not of form k=v, ignoring: {override}",
                 UserWarning,
             )
-        else:
-            out[keyval[0]] = keyval[1]
+            continue
+        out[key] = val
 
     return out
 
@@ -140,41 +207,201 @@ def get_sbatch_config(configfile, overrides):
 
 
 def substitute_nth(nth, params, command):
-    nth_values = nth_product(nth, params.values())
-    nth_dict = dict(zip(params.keys(), nth_values))
-    return command.format_map(nth_dict)
+    keys, pools, strides = _compile_params(params)
+    total = prod(map(len, pools))
 
+    if nth < 0:
+        nth += total
 
-def make_sbatch_headers(config):
-    outstr = ""
-    for key, val in config.items():
-        if len(key) == 1:
-            outstr += f"#SBATCH -{key} {val}\n"
-        else:
-            outstr += f"#SBATCH --{key}={val}\n"
+    if not 0 <= nth < total:
+        raise IndexError
 
-    return outstr
+    return command.format_map(_LazyParams(keys, pools, strides, nth))
 
 
-def make_batchfile_contents(setup, command, paramfile, config):
-    # pylint: disable=unused-argument, possibly-unused-variable
-    contents_template = """#!/bin/bash
-{sbatch_config}
+_CONVERSIONS = {"r": repr, "s": str, "a": ascii}
 
-cd {pwd}
 
-command=$(python3 {slurm_utils_dir}/slurm_utils.py --nth=$SLURM_ARRAY_TASK_ID \
-          --paramfile={paramfile} --command="{command}")
+def _expand_commands(params, command, escape=None):
+    """Generate the substituted command for every parameter combination.
 
-{setup}
+    The parameters are only prepared once, rather than once per command
+    as repeated calls to `substitute_nth` would.  If `escape` is given,
+    it is applied to each formatted parameter value, but not to the rest
+    of the command.
+    """
+    keys, pools, strides = _compile_params(params)
+    total = prod(map(len, pools))
+    segments = _compile_command(command, keys)
+
+    if segments is None:
+        formatter = _CommandFormatter(escape)
+        for nth in range(total):
+            lazy_params = _LazyParams(keys, pools, strides, nth)
+            yield formatter.vformat(command, (), lazy_params)
+        return
+
+    for nth in range(total):
+        parts = []
+        for literal, axis, conversion, format_spec in segments:
+            parts.append(literal)
+            if axis is not None:
+                value = _nth_value(pools[axis], strides[axis], nth)
+                if conversion is not None:
+                    value = _CONVERSIONS[conversion](value)
+                text = format(value, format_spec)
+                if escape is not None:
+                    text = escape(text)
+                parts.append(text)
+        yield "".join(parts)
+
+
+def _compile_command(command, keys):
+    """Parse `command` into segments for repeated substitution.
+
+    Each segment is a tuple (literal, axis, conversion, format_spec), where
+    axis is the position of the parameter to substitute after the literal
+    text, or None if there is none.  Returns None if the command uses
+    anything more than plain parameter names with simple conversions and
+    format specs; such commands should be substituted with
+    `_CommandFormatter`, which also raises the appropriate errors for
+    invalid commands.
+    """
+    segments = []
+    try:
+        parsed = list(string.Formatter().parse(command))
+    except ValueError:
+        return None
+
+    for literal, field_name, format_spec, conversion in parsed:
+        if field_name is None:
+            segments.append((literal, None, None, ""))
+            continue
+        if (
+            field_name not in keys
+            or field_name.isdigit()
+            or "." in field_name
+            or "[" in field_name
+            or "{" in format_spec
+            or (conversion is not None and conversion not in _CONVERSIONS)
+        ):
+            return None
+        segments.append((literal, keys[field_name], conversion, format_spec))
+
+    return segments
+
+
+def _compile_params(params):
+    """Prepare `params` for substitution.
+
+    Returns a dict mapping each parameter name to its position, along with
+    the pools and strides from `_compile_product`.
+    """
+    keys = {key: axis for axis, key in enumerate(params)}
+    pools, strides = _compile_product(params.values())
+    return keys, pools, strides
+
+
+class _LazyParams:
+    """The values of the nth parameter combination, for use by format_map.
+
+    Each parameter value is only decoded from the index when the command
+    asks for it, so no dict of all of the values is built.
+    """
+
+    __slots__ = ("keys", "pools", "strides", "index")
+
+    def __init__(self, keys, pools, strides, index):
+        self.keys = keys
+        self.pools = pools
+        self.strides = strides
+        self.index = index
+
+    def __getitem__(self, key):
+        axis = self.keys[key]
+        return _nth_value(self.pools[axis], self.strides[axis], self.index)
 
-$command
-"""
 
-    sbatch_config = make_sbatch_headers(config)
-    pwd = os.getcwd()
-    slurm_utils_dir = os.path.dirname(__file__)
-    contents = contents_template.format_map(locals())
+def _nth_value(pool, stride, nth):
+    """The value from `pool` in the nth parameter combination."""
+    return pool[nth // stride % len(pool)]
+
+
+class _CommandFormatter(string.Formatter):
+    """A formatter for commands which cannot be precompiled.
+
+    It behaves like format_map, but also applies `escape`, if given, to
+    each formatted field.
+    """
+
+    def __init__(self, escape=None):
+        super().__init__()
+        self.escape = escape
+
+    def get_value(self, key, args, kwargs):
+        # Match format_map, which does not accept positional fields
+        if isinstance(key, int):
+            raise ValueError("Format string contains positional fields")
+        return kwargs[key]
+
+    def format_field(self, value, format_spec):
+        text = super().format_field(value, format_spec)
+        if self.escape is not None:
+            text = self.escape(text)
+        return text
+
+
+_DOUBLE_QUOTE_ESCAPES = str.maketrans({char: "\\" + char for char in '\\"$`'})
+
+
+def _escape_double_quoted(text):
+    """Escape `text` so that bash reads it literally within double quotes."""
+    return text.translate(_DOUBLE_QUOTE_ESCAPES)
+
+
+def make_sbatch_headers(config):
+    lines = [
+        f"#SBATCH -{key} {val}\n"
+        if len(key) == 1
+        else f"#SBATCH --{key}={val}\n"
+        for key, val in config.items()
+    ]
+
+    return "".join(lines)
+
+
+def make_batchfile_contents(setup, command, paramfile, config):
+    """Produce the contents of the sbatch script.
+
+    The commands for every task in the array are computed here and
+    written into the script as a case statement on the task ID, so that
+    the tasks themselves do not need to run Python or read the parameter
+    file, and each task only expands its own command.  Each command is
+    placed within double quotes, with the parameter values escaped so
+    that bash does not interpret them; the rest of the command is
+    interpreted by bash, as it always was.  A task ID with no command
+    makes the task fail with an error message.
+
+    A ``KeyError`` is raised if the command uses a parameter which is not
+    in the parameter file, and a ``ValueError`` if the command is not a
+    valid format string or uses positional fields such as ``{}``.
+    """
+    if command is None:
+        raise ValueError("Need to specify a command")
+
+    params = read_paramfile(paramfile)
+    commands = "".join(
+        f'    {nth}) command="{nth_command}" ;;\n'
+        for nth, nth_command in enumerate(
+            _expand_commands(params, command, escape=_escape_double_quoted)
+        )
+    )
+    contents = _BATCHFILE_TEMPLATE.substitute(
+        sbatch_config=make_sbatch_headers(config),
+        pwd=os.getcwd(),
+        commands=commands,
+        setup=setup or "",
+    )
 
     return contents
 
@@ -189,20 +416,31 @@ def write_sbatch_file(batchfile_contents, sbatch_filename):
 
 
 def write_sbatch_named_file(batchfile_contents, sbatch_filename):
-    with open(sbatch_filename, "w", encoding="UTF-8") as outfile:
-        print(batchfile_contents, end="", file=outfile)
+    fd = os.open(sbatch_filename, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+    _write_and_close(fd, batchfile_contents)
 
 
 def write_sbatch_temporary_file(batchfile_contents):
-    with tempfile.NamedTemporaryFile(
-        mode="w", encoding="UTF-8", delete=False
-    ) as outfile:
-        sbatch_filename = outfile.name
-        print(batchfile_contents, end="", file=outfile)
+    fd, sbatch_filename = tempfile.mkstemp()
+    _write_and_close(fd, batchfile_contents)
 
     return sbatch_filename
 
 
+def _write_and_close(fd, contents):
+    """Write the string `contents` to the file descriptor `fd` and close it.
+
+    The contents are encoded once and written directly with os.write,
+    bypassing Python's buffered text layer.
+    """
+    try:
+        data = contents.encode("UTF-8")
+        while data:
+            data = data[os.write(fd, data) :]
+    finally:
+        os.close(fd)
+
+
 def build_parser():
     parser = argparse.ArgumentParser()
     parser.add_argument(
@@ -221,10 +459,15 @@ def build_parser():
         help="Substitute the nth parameter option into the command string",
         type=int,
     )
+    parser.add_argument(
+        "--expand-all",
+        help="Print the command for every parameter option, one per line",
+        action="store_true",
+    )
     parser.add_argument(
         "--command",
         help="String with parameters indicated as {dataset}, to be "
-        "substituted when called with --nth",
+        "substituted when called with --nth or --expand-all",
         type=str,
     )
 
@@ -247,6 +490,13 @@ def main():
         if args.command is None:
             raise ValueError("Need to specify a command when using --nth")
         print(substitute_nth(args.nth, params, args.command))
+    elif args.expand_all:
+        if args.command is None:
+            raise ValueError(
+                "Need to specify a command when using --expand-all"
+            )
+        for nth_command in _expand_commands(params, args.command):
+            print(nth_command)
 
 
 if __name__ == "__main__":
@@ -1,19 +1,18 @@
 import argparse
-from collections import OrderedDict
-from collections.abc import Collection, Sequence
+from collections.abc import Collection, Mapping, Sequence
 from typing import Any, Optional
 
-Params = OrderedDict[str, list[Any]]
+Params = dict[str, list[Any]]
 
 
 def get_count(params: Params) -> int: ...
-def read_toml(filename: str) -> OrderedDict[Any, Any]: ...
+def read_toml(filename: str) -> Mapping[str, Any]: ...
 def read_paramfile(filename: str) -> Params: ...
-def validate_param_dict(dict_lists: OrderedDict[Any, Any]) -> Params: ...
+def validate_param_dict(dict_lists: Mapping[Any, Any]) -> Params: ...
 def count_product(lists: Sequence[Collection[Any]]) -> int: ...
 def nth_product(index: int, lists: Sequence[Collection[Any]]) -> tuple[Any, ...]: ...
 def get_array_argument(template: str, paramfile: str) -> str: ...
-def overrides_to_dict(overrides: list[str]) -> OrderedDict[str, str]: ...
+def overrides_to_dict(overrides: list[str]) -> dict[str, str]: ...
 def get_sbatch_config(
     configfile: str, overrides: Optional[list[str]]
 ) -> dict[str, str]: ...
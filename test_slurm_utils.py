@@ -1,4 +1,7 @@
+import itertools
 import os
+import shutil
+import subprocess
 
 import pytest
 
@@ -15,6 +18,30 @@ def test_nth_product():
     assert result == (2, "a", "xxx")
 
 
+def test_nth_product_all():
+    lists = [[1, 2, 5], ["a", "c"], ["xxx"], [7, 8, 9, 10]]
+    products = list(itertools.product(*lists))
+    for index in range(-len(products), len(products)):
+        assert slurm_utils.nth_product(index, lists) == products[index]
+
+
+@pytest.mark.parametrize(
+    "index,lists",
+    [
+        (24, [[1, 2, 5], ["a", "c"], [7, 8, 9, 10]]),
+        (-25, [[1, 2, 5], ["a", "c"], [7, 8, 9, 10]]),
+        (0, [[1, 2, 5], [], ["xxx"]]),
+    ],
+)
+def test_nth_product_bad_index(index, lists):
+    with pytest.raises(IndexError):
+        slurm_utils.nth_product(index, lists)
+
+
+def test_nth_product_no_lists():
+    assert slurm_utils.nth_product(0, []) == ()
+
+
 def test_read_toml():
     data = slurm_utils.read_toml("testfiles/params.toml")
     expected = {
@@ -43,6 +70,34 @@ def test_read_toml_bad():
     assert data == expected
 
 
+def test_read_toml_cached(tmp_path):
+    tomlpath = tmp_path / "params.toml"
+    tomlpath.write_text('dataset = ["A", "B"]\n', encoding="UTF-8")
+    first = slurm_utils.read_toml(str(tomlpath))
+    assert slurm_utils.read_toml(str(tomlpath)) is first
+
+    with pytest.raises(TypeError):
+        first["dataset"] = ["C"]
+
+    tomlpath.write_text('dataset = ["C"]\n', encoding="UTF-8")
+    os.utime(tomlpath, (0, 0))
+    assert slurm_utils.read_toml(str(tomlpath)) == {"dataset": ["C"]}
+
+
+
+def test_read_toml_cached_relative(tmp_path, monkeypatch):
+    """The same relative name in two directories is two different files"""
+    for subdir, value in (("a", 1), ("b", 2)):
+        (tmp_path / subdir).mkdir()
+        tomlpath = tmp_path / subdir / "params.toml"
+        tomlpath.write_text(f"x = [{value}]\n", encoding="UTF-8")
+        os.utime(tomlpath, (0, 0))
+
+    monkeypatch.chdir(tmp_path / "a")
+    assert slurm_utils.read_toml("params.toml") == {"x": [1]}
+    monkeypatch.chdir(tmp_path / "b")
+    assert slurm_utils.read_toml("params.toml") == {"x": [2]}
+
 def test_read_paramfile():
     params = slurm_utils.read_paramfile("testfiles/params.toml")
     expected = {
@@ -57,6 +112,14 @@ def test_read_paramfile():
     assert params == expected
 
 
+def test_read_paramfile_copies_lists():
+    params = slurm_utils.read_paramfile("testfiles/params.toml")
+    params["dataset"].append("OTHER")
+
+    params = slurm_utils.read_paramfile("testfiles/params.toml")
+    assert params["dataset"] == ["SYNTHETIC"]
+
+
 def test_read_paramfile_bad():
     with pytest.warns(UserWarning):
         params = slurm_utils.read_paramfile("testfiles/paramsbad.toml")
@@ -176,7 +239,7 @@ source activate local_python_venv
     command = (
         "python3 longscript.py {dataset} {imputation} "
         "{train_percentage} {test_percentage} {holdout_set} {val_set} "
-        "{repeat} {nfeat} {nmar} {nshuff}"
+        "{repeat} $HOME"
     )
     overrides = None
     config = slurm_utils.get_sbatch_config(
@@ -190,7 +253,7 @@ source activate local_python_venv
 
     pwd = os.getcwd()
 
-    result = """#!/bin/bash
+    head = """#!/bin/bash
 #SBATCH -p mynode
 #SBATCH -A MY-ACCOUNT
 #SBATCH -N 2
@@ -200,8 +263,13 @@ source activate local_python_venv
 
 cd PWD
 
-command=$(python3 PWD/slurm_utils.py --nth=$SLURM_ARRAY_TASK_ID \
-          --paramfile=PARAMFILE --command="COMMAND")
+case "$SLURM_ARRAY_TASK_ID" in
+"""
+    tail = """    *)
+        echo "No command for array task $SLURM_ARRAY_TASK_ID" >&2
+        exit 1
+        ;;
+esac
 
 
 module load miniconda3
@@ -210,11 +278,136 @@ source activate local_python_venv
 
 $command
 """
-    result = result.replace("PWD", pwd)
-    result = result.replace("PARAMFILE", paramfile)
-    result = result.replace("COMMAND", command)
+    head = head.replace("PWD", pwd)
+
+    assert batchfile.startswith(head)
+    assert batchfile.endswith(tail)
+
+    commands = batchfile[len(head) : -len(tail)].splitlines()
+    assert len(commands) == 900
+    assert commands[0] == (
+        '    0) command='
+        '"python3 longscript.py SYNTHETIC MICE 0.25 0.5 0 0 0 $HOME" ;;'
+    )
+    assert commands[371] == (
+        '    371) command='
+        '"python3 longscript.py SYNTHETIC GAIN 0.25 0.5 1 2 1 $HOME" ;;'
+    )
+    assert commands[899] == (
+        '    899) command='
+        '"python3 longscript.py SYNTHETIC Mean 0.5 0.5 2 4 9 $HOME" ;;'
+    )
+
+
+def test_make_batchfile_contents_shell_values():
+    command = "echo {msg} {n}"
+    paramfile = "testfiles/paramsshell.toml"
+
+    batchfile = slurm_utils.make_batchfile_contents(
+        None, command, paramfile, {}
+    )
+
+    expected = r"""case "$SLURM_ARRAY_TASK_ID" in
+    0) command="echo say \"hi\" 1" ;;
+    1) command="echo say \"hi\" 2" ;;
+    2) command="echo cost \$5 1" ;;
+    3) command="echo cost \$5 2" ;;
+    4) command="echo a\`id\`b 1" ;;
+    5) command="echo a\`id\`b 2" ;;
+    6) command="echo x\" \"y 1" ;;
+    7) command="echo x\" \"y 2" ;;
+    8) command="echo back\\slash 1" ;;
+    9) command="echo back\\slash 2" ;;
+    10) command="echo plain 1" ;;
+    11) command="echo plain 2" ;;
+    *)
+"""
+    assert expected in batchfile
 
-    assert batchfile == result
+
+@pytest.mark.skipif(shutil.which("bash") is None, reason="needs bash")
+def test_make_batchfile_contents_shell_roundtrip():
+    """bash should read back exactly the substituted parameter values"""
+    command = "echo {msg} {n}"
+    paramfile = "testfiles/paramsshell.toml"
+
+    batchfile = slurm_utils.make_batchfile_contents(
+        None, command, paramfile, {}
+    )
+    start = batchfile.index("case ")
+    end = batchfile.index("esac\n") + len("esac\n")
+    script = (
+        "for SLURM_ARRAY_TASK_ID in $(seq 0 11); do\n"
+        + batchfile[start:end]
+        + 'printf "%s\\n" "$command"\n'
+        + "done\n"
+    )
+    result = subprocess.run(
+        ["bash", "-c", script],
+        capture_output=True,
+        check=True,
+        encoding="UTF-8",
+    )
+
+    params = slurm_utils.read_paramfile(paramfile)
+    expected = [
+        slurm_utils.substitute_nth(nth, params, command) for nth in range(12)
+    ]
+    assert result.stdout.splitlines() == expected
+
+
+def run_batchfile(tmp_path, monkeypatch, command, task_id):
+    paramfile = os.path.abspath("testfiles/paramsshell.toml")
+    monkeypatch.chdir(tmp_path)
+    batchfile = slurm_utils.make_batchfile_contents(
+        None, command, paramfile, {}
+    )
+    (tmp_path / "sbatch.sh").write_text(batchfile, encoding="UTF-8")
+
+    return subprocess.run(
+        ["bash", "sbatch.sh"],
+        capture_output=True,
+        encoding="UTF-8",
+        env=dict(os.environ, SLURM_ARRAY_TASK_ID=str(task_id)),
+    )
+
+
+@pytest.mark.skipif(shutil.which("bash") is None, reason="needs bash")
+def test_make_batchfile_contents_expands_one_command(tmp_path, monkeypatch):
+    """Only the task's own command should be expanded by bash"""
+    command = "echo {n} $(echo side >> log; echo x)"
+    result = run_batchfile(tmp_path, monkeypatch, command, 1)
+
+    assert result.returncode == 0
+    assert result.stdout == "2 x\n"
+    log = (tmp_path / "log").read_text(encoding="UTF-8")
+    assert log == "side\n"
+
+
+@pytest.mark.skipif(shutil.which("bash") is None, reason="needs bash")
+def test_make_batchfile_contents_bad_task_id(tmp_path, monkeypatch):
+    result = run_batchfile(tmp_path, monkeypatch, "echo {msg} {n}", 12)
+
+    assert result.returncode == 1
+    assert result.stdout == ""
+    assert result.stderr == "No command for array task 12\n"
+
+
+def test_make_batchfile_contents_unknown_parameter():
+    """An unknown parameter name is an error when the script is made"""
+    command = "python3 longscript.py {dataset} {unknown}"
+
+    with pytest.raises(KeyError):
+        slurm_utils.make_batchfile_contents(
+            None, command, "testfiles/params.toml", {}
+        )
+
+
+def test_make_batchfile_contents_no_command():
+    with pytest.raises(ValueError):
+        slurm_utils.make_batchfile_contents(
+            None, None, "testfiles/params.toml", {}
+        )
 
 
 def test_write_sbatch_file_named(tmp_path):
@@ -245,3 +438,88 @@ echo This is some test content
     assert written == content
 
     os.remove(returned_filename)
+
+
+def test_main_expand_all(monkeypatch, capsys):
+    monkeypatch.setattr(
+        "sys.argv",
+        [
+            "slurm_utils.py",
+            "--paramfile=testfiles/params.toml",
+            "--expand-all",
+            "--command=run {imputation} {repeat}",
+        ],
+    )
+    slurm_utils.main()
+
+    lines = capsys.readouterr().out.splitlines()
+    assert len(lines) == 900
+    assert lines[0] == "run MICE 0"
+    assert lines[371] == "run GAIN 1"
+    assert lines[-1] == "run Mean 9"
+
+
+@pytest.mark.parametrize(
+    "command",
+    [
+        "python3 myscript.py {dataset} --val={val_set} --repeat={repeat}",
+        "no parameters {{here}}",
+        "",
+        "{imputation!r} {dataset!s} {imputation!a}",
+        "{train_percentage:.2f} {repeat:03d} {imputation:>8}",
+        "{imputation!r:>10}",
+        # These cannot be precompiled, so fall back to format_map
+        "{imputation[0]}",
+        "{repeat:{val_set}}",
+        "{train_percentage.real}",
+    ],
+)
+def test_expand_commands(command):
+    params = slurm_utils.read_paramfile("testfiles/params.toml")
+    expected = [
+        slurm_utils.substitute_nth(nth, params, command) for nth in range(900)
+    ]
+    assert list(slurm_utils._expand_commands(params, command)) == expected
+
+
+@pytest.mark.parametrize(
+    "command,error",
+    [
+        ("{}", ValueError),
+        ("{0}", ValueError),
+        ("{unknown}", KeyError),
+        ("{dataset.unknown}", AttributeError),
+        ("{repeat!x}", ValueError),
+        ("{dataset", ValueError),
+        ("dataset}", ValueError),
+    ],
+)
+@pytest.mark.parametrize(
+    "escape", [None, slurm_utils._escape_double_quoted]
+)
+def test_expand_commands_bad(command, error, escape):
+    params = slurm_utils.read_paramfile("testfiles/params.toml")
+    with pytest.raises(error):
+        slurm_utils.substitute_nth(0, params, command)
+    with pytest.raises(error):
+        list(slurm_utils._expand_commands(params, command, escape=escape))
+
+
+@pytest.mark.parametrize(
+    "command,first,fourth",
+    [
+        ("{msg!r:>12} {n}", r"""  'say \"hi\"' 1""", r"""   'cost \$5' 2"""),
+        # A nested format spec cannot be precompiled
+        ("{msg!r:>{n}} {n}", r"""'say \"hi\"' 1""", r"""'cost \$5' 2"""),
+    ],
+)
+def test_expand_commands_escape(command, first, fourth):
+    """Escaping applies to formatted values, whether or not precompiled"""
+    params = slurm_utils.read_paramfile("testfiles/paramsshell.toml")
+    commands = list(
+        slurm_utils._expand_commands(
+            params, command, escape=slurm_utils._escape_double_quoted
+        )
+    )
+    assert commands[0] == first
+    assert commands[3] == fourth